@@ -0,0 +1,338 @@
+"""
+load.py - Benchmark the record and playback paths with synthetic traces.
+
+Each scenario generates an input trace, feeds it to log.Writer through the
+same calls as the hook procedure of record.py, and replays the log with
+playback.playback() through a fake SendInput. The clock of the writer and
+the sleep of playback are faked, so the traces run as fast as possible while
+the log keeps the synthetic timing.
+
+Parsing the log with log.Reader, compiling it into a log.Template and the
+playback loop are timed separately. The trace is generated lazily and every
+scenario runs in a new process, so the reported RSS is the growth of the
+peak RSS caused by log and playback only.
+
+Example:
+    $ python benchmarks/load.py
+    # Fail if a metric regressed compared with the baseline.
+    $ python benchmarks/load.py --compare
+    # Record the current machine as the baseline.
+    $ python benchmarks/load.py --update
+"""
+import os
+import sys
+import json
+import time
+import types
+import random
+import logging
+import argparse
+import resource
+import tempfile
+import subprocess
+from array import array
+from ctypes import addressof
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import log        # noqa: E402
+import monitor    # noqa: E402
+import playback   # noqa: E402
+from win_const import *     # noqa: E402
+
+BASELINE = os.path.join(ROOT, "benchmarks", "load_baseline.json")
+
+LAYOUT = monitor.Layout([(0, 0, 1920, 1080, True)])
+END_KEY = 0xA2      # LCTRL
+
+# Metric name and whether a larger value is better.
+METRICS = {
+    "record_events_per_sec": True,
+    "record_p99_us": False,
+    "parse_ms": False,
+    "compile_ms": False,
+    "playback_events_per_sec": True,
+    "peak_rss_kb": False,
+    "file_size": False
+}
+
+
+def mouse_sweep(seconds, hz=1000):
+    """Mouse moving across the screen at `hz`, with a click every second.
+
+    Yield:
+        (time, wParam, hook structure) tuples.
+    """
+    for i in range(int(seconds * hz)):
+        t = i / hz
+        mouse = MSLLHOOKSTRUCT()
+        mouse.pt.x = int(t * 500) % 1920
+        mouse.pt.y = int(540 + 400 * ((i % 2000) / 1000 - 1))
+        msg = WM_MOUSEMOVE
+        if i % hz == 0:
+            msg = WM_LBUTTONDOWN
+        elif i % hz == 50:
+            msg = WM_LBUTTONUP
+        yield t, msg, mouse
+
+
+def typing_bursts(seconds, rng):
+    """Bursts of typing at about 10 keys per second with short pauses."""
+    keys = [vk for vk in range(0x41, 0x5B)]
+    t = 0
+    while t < seconds:
+        for _ in range(rng.randint(5, 40)):
+            vk = rng.choice(keys)
+            for msg in (WM_KEYDOWN, WM_KEYUP):
+                kb = KBDLLHOOKSTRUCT()
+                kb.vkCode = vk
+                yield t, msg, kb
+                t += rng.uniform(0.02, 0.08)
+        t += rng.uniform(0.5, 2)
+
+
+def idle_periods(seconds, rng):
+    """Sparse clicks separated by idle periods of up to a minute."""
+    t = 0
+    while t < seconds:
+        mouse = MSLLHOOKSTRUCT()
+        mouse.pt.x, mouse.pt.y = rng.randrange(1920), rng.randrange(1080)
+        yield t, WM_LBUTTONDOWN, mouse
+        yield t + 0.1, WM_LBUTTONUP, mouse
+        t += rng.uniform(10, 60)
+
+
+SCENARIOS = {
+    "mouse": lambda seconds, rng: mouse_sweep(seconds),
+    "typing": lambda seconds, rng: typing_bursts(seconds * 100, rng),
+    "idle": lambda seconds, rng: idle_periods(seconds * 10000, rng),
+}
+
+
+class FakeClock:
+    """Replacement of datetime for log.Writer following the trace time."""
+    start = datetime(2000, 1, 1)
+    now_time = 0
+
+    @classmethod
+    def now(cls):
+        return cls.start + timedelta(seconds=cls.now_time)
+
+
+def percentile(sorted_values, p):
+    return sorted_values[int(p / 100 * (len(sorted_values) - 1))]
+
+
+def peak_rss_kb() -> int:
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def record(trace, filepath) -> array:
+    """Write a trace with log.Writer as the hooks of record.py do.
+
+    Return:
+        Latency of each hook call in seconds.
+    """
+    log.datetime = FakeClock
+    try:
+        writer = log.Writer(filepath, END_KEY, LAYOUT)
+        latencies = array("d")
+        for t, msg, struct in trace:
+            FakeClock.now_time = t
+            lparam = addressof(struct)
+            begin = time.perf_counter()
+            if not writer.keyboardll_msg(msg, lparam):
+                writer.mousell_msg(msg, lparam)
+            latencies.append(time.perf_counter() - begin)
+        writer.wait_event()
+        writer.file.close()
+    finally:
+        log.datetime = datetime
+    return latencies
+
+
+def parse(filepath) -> int:
+    """Read a log with log.Reader only.
+
+    Return:
+        The number of steps in the log.
+    """
+    reader = log.Reader(filepath, LAYOUT)
+    steps = 0
+    for _ in reader.get_next_input_array():
+        steps += 1
+    return steps
+
+
+def replay(template) -> int:
+    """Replay a template with playback.playback() through a fake SendInput.
+
+    The sleeps are skipped, so the time spent is rendering the template and
+    building the INPUT arrays of each run.
+
+    Return:
+        The number of events sent.
+    """
+    sent = 0
+
+    def send_input(in_arr):
+        nonlocal sent
+        sent += 1
+
+    playback.time = types.SimpleNamespace(sleep=lambda seconds: None)
+    original = playback.send_input
+    playback.send_input = send_input
+    try:
+        playback.playback(template, 1, LAYOUT)
+    finally:
+        playback.time = time
+        playback.send_input = original
+    return sent
+
+
+def run(scenario, seconds, seed) -> dict:
+    """Run a scenario in this process and collect the metrics."""
+    trace = SCENARIOS[scenario](seconds, random.Random(seed))
+    with tempfile.TemporaryDirectory() as tmp:
+        filepath = os.path.join(tmp, "log.txt")
+        rss_before = peak_rss_kb()
+
+        begin = time.perf_counter()
+        record_latencies = record(trace, filepath)
+        record_time = time.perf_counter() - begin
+        events = len(record_latencies)
+
+        begin = time.perf_counter()
+        steps = parse(filepath)
+        parse_time = time.perf_counter() - begin
+
+        begin = time.perf_counter()
+        template = log.Template(filepath, LAYOUT)
+        compile_time = time.perf_counter() - begin
+
+        begin = time.perf_counter()
+        sent = replay(template)
+        replay_time = time.perf_counter() - begin
+
+        rss = peak_rss_kb() - rss_before
+        file_size = os.path.getsize(filepath)
+
+    record_latencies = sorted(record_latencies)
+    return {
+        "events": events,
+        "steps": steps,
+        "sent": sent,
+        "record_events_per_sec": events / record_time,
+        "record_p50_us": percentile(record_latencies, 50) * 1e6,
+        "record_p99_us": percentile(record_latencies, 99) * 1e6,
+        "parse_ms": parse_time * 1e3,
+        "compile_ms": compile_time * 1e3,
+        "playback_events_per_sec": sent / replay_time,
+        "peak_rss_kb": rss,
+        "file_size": file_size
+    }
+
+
+def run_all(args) -> dict:
+    """Run every scenario in a new process."""
+    results = {}
+    for scenario in args.scenario:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child",
+             "--scenario", scenario, "--seconds", str(args.seconds),
+             "--seed", str(args.seed)],
+            stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        results[scenario] = json.loads(output.stdout)
+    return results
+
+
+def compare(results, baseline, threshold) -> bool:
+    """Log the ratio of each metric to the baseline.
+
+    Return:
+        True if any metric regressed over the threshold.
+    """
+    regressed = False
+    for scenario, metrics in results.items():
+        for name, larger_is_better in METRICS.items():
+            base = baseline[scenario][name]
+            if base:
+                ratio = metrics[name] / base
+            else:
+                # e.g. no RSS growth at all in the baseline.
+                ratio = 1.0 if not metrics[name] else float("inf")
+            worse = 1 / ratio if larger_is_better else ratio
+            logging.info("{} {}: {:.1f} ({:.2f}x baseline)".format(
+                scenario, name, metrics[name], ratio))
+            if worse > threshold:
+                logging.error("{} {} regressed over {:.2f}x.".format(
+                    scenario, name, threshold))
+                regressed = True
+    return regressed
+
+
+def parse_arg():
+    """Benchmark log.Writer, log.Reader and the playback loop."""
+    parser = argparse.ArgumentParser(description=parse_arg.__doc__)
+    parser.add_argument(
+        "-s", "--scenario", type=str, action="append",
+        choices=list(SCENARIOS), help="scenarios to run, all by default")
+    parser.add_argument(
+        "--seconds", type=float, default=60,
+        help="length of the mouse sweep; the other traces are scaled")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-b", "--baseline", type=str, default=BASELINE)
+    parser.add_argument(
+        "-t", "--threshold", type=float, default=2.0,
+        help="maximum allowed ratio to the baseline")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "-c", "--compare", action="store_true",
+        help="compare with the baseline and fail on regressions")
+    group.add_argument(
+        "-u", "--update", action="store_true",
+        help="write the result as the new baseline")
+    parser.add_argument("--child", action="store_true",
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.scenario = args.scenario or list(SCENARIOS)
+    return args
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.WARNING,
+        format="[%(filename)s:%(lineno)d][%(levelname)s] %(message)s")
+
+    args = parse_arg()
+    if args.child:
+        print(json.dumps(run(args.scenario[0], args.seconds, args.seed)))
+        sys.exit(0)
+
+    logging.getLogger().setLevel(logging.INFO)
+    # The traces depend on these, so results of other values are not
+    # comparable.
+    parameters = {"seconds": args.seconds, "seed": args.seed}
+    if args.compare:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        if baseline.get("parameters") != parameters:
+            logging.error(
+                "The baseline was made with {}, but got {}.".format(
+                    baseline.get("parameters"), parameters))
+            sys.exit(1)
+
+    results = run_all(args)
+
+    if args.update:
+        with open(args.baseline, "w") as f:
+            json.dump(dict(parameters=parameters, **results), f, indent=4)
+            f.write("\n")
+        logging.info("Baseline written to {}.".format(args.baseline))
+    elif args.compare:
+        sys.exit(1 if compare(results, baseline, args.threshold) else 0)
+    else:
+        print(json.dumps(results, indent=4))
@@ -0,0 +1,125 @@
+"""
+startup.py - Measure the import time of record.py and playback.py.
+
+The cumulative import time of each module is taken from the output of
+`python -X importtime` in a fresh interpreter. It is divided by the import
+time of REFERENCE measured the same way, so the result does not depend on
+the speed of the machine. The runs of the reference and the modules are
+interleaved, and the median of the ratios of many runs is compared with a
+baseline file. The script exits with 1 if a module is slower than the
+baseline by more than the threshold.
+
+Example:
+    $ python benchmarks/startup.py
+    # Record the current machine as the baseline.
+    $ python benchmarks/startup.py --update
+"""
+import os
+import re
+import sys
+import json
+import argparse
+import logging
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(ROOT, "benchmarks", "startup_baseline.json")
+
+MODULES = ["record", "playback"]
+
+# Standard modules of similar weight used by record.py and playback.py.
+REFERENCE = "json, logging, ctypes"
+
+# import time:   self [us] | cumulative | imported package
+IMPORTTIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def import_time(modules) -> int:
+    """Import modules in a new interpreter and get their cumulative time.
+
+    Args:
+        modules: Comma separated names of the modules to be imported.
+
+    Return:
+        Cumulative import time in microseconds.
+    """
+    names = [name.strip() for name in modules.split(",")]
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import " + modules],
+        cwd=ROOT, stderr=subprocess.PIPE, universal_newlines=True,
+        check=True)
+    total = 0
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME.match(line)
+        # The top-level modules are the ones without indentation.
+        if match and match.group(4) in names and len(match.group(3)) == 1:
+            total += int(match.group(2))
+    if not total:
+        raise RuntimeError("No import time reported for " + modules)
+    return total
+
+
+def measure(runs) -> dict:
+    """Get the median import time of each module in MODULES.
+
+    Return:
+        A dictionary mapping the module to its import time relative to the
+        import time of REFERENCE.
+    """
+    # Interleave the runs and compare each module with the reference of the
+    # same round, so a change of the machine load affects both alike.
+    ratios = {module: [] for module in MODULES}
+    for _ in range(runs):
+        reference = import_time(REFERENCE)
+        for module, values in ratios.items():
+            values.append(import_time(module) / reference)
+    return {
+        module: statistics.median(values)
+        for module, values in ratios.items()
+    }
+
+
+def parse_arg():
+    """Benchmark the startup of record.py and playback.py."""
+    parser = argparse.ArgumentParser(description=parse_arg.__doc__)
+    parser.add_argument("-r", "--runs", type=int, default=30)
+    parser.add_argument("-b", "--baseline", type=str, default=BASELINE)
+    parser.add_argument(
+        "-t", "--threshold", type=float, default=1.5,
+        help="maximum allowed ratio to the baseline")
+    parser.add_argument(
+        "-u", "--update", action="store_true",
+        help="write the result as the new baseline")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(filename)s:%(lineno)d][%(levelname)s] %(message)s")
+
+    args = parse_arg()
+    result = measure(args.runs)
+
+    if args.update:
+        with open(args.baseline, "w") as f:
+            json.dump(result, f, indent=4)
+            f.write("\n")
+        logging.info("Baseline written to {}.".format(args.baseline))
+        sys.exit(0)
+
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+
+    regressed = False
+    for module, relative in result.items():
+        ratio = relative / baseline[module]
+        logging.info(
+            "import {}: {:.2f}x reference ({:.2f}x baseline)".format(
+                module, relative, ratio))
+        if ratio > args.threshold:
+            logging.error("import {} regressed over {:.2f}x.".format(
+                module, args.threshold))
+            regressed = True
+    sys.exit(1 if regressed else 0)
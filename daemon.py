@@ -0,0 +1,485 @@
+"""
+daemon.py - Resident playback service controlled through a local socket.
+
+The service keeps the parsed macros in memory, so replaying a macro again
+skips the interpreter startup and the log parsing of playback.py. Commands
+and replies are JSON objects, one per line:
+
+    {"cmd": "play", "file": "log.txt", "repeat": 3, "vars": {"user": "bob"}}
+    {"cmd": "stop", "all": false}
+    {"cmd": "status"}
+
+A play command is answered with a "queued" reply, then "start", "progress"
+and "done" replies of the job until it finishes.
+
+Every command carries the "token" written by the service to a file only
+readable by the user, so other local users and processes cannot inject
+input into the session. The socket is also kept in a per-user directory.
+
+Example:
+    $ python daemon.py serve
+    $ python daemon.py play --file log.txt --var user=bob
+    $ python daemon.py status
+    $ python daemon.py stop
+"""
+import os
+import sys
+import hmac
+import json
+import stat
+import time
+import asyncio
+import hashlib
+import logging
+import secrets
+import argparse
+import tempfile
+import itertools
+import threading
+from collections import OrderedDict
+
+import log
+
+
+def _runtime_dir() -> str:
+    """Get the per-user directory of the socket and the token file."""
+    if os.name == "nt":
+        # The profile directory is only accessible by its user.
+        base = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+        return os.path.join(base, "macrorecorder")
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], "macrorecorder")
+    return os.path.join(tempfile.gettempdir(),
+                        "macrorecorder-{}".format(os.getuid()))
+
+
+RUNTIME_DIR = _runtime_dir()
+TOKEN_FILE = os.path.join(RUNTIME_DIR, "token")
+
+# Unix domain sockets are used where asyncio supports them, otherwise the
+# service listens on the loopback interface.
+UNIX_SOCKET = hasattr(asyncio, "start_unix_server")
+DEFAULT_ADDRESS = os.path.join(RUNTIME_DIR, "daemon.sock") \
+    if UNIX_SOCKET else "127.0.0.1:47800"
+
+CACHE_SIZE = 32             # Number of compiled macros kept in memory
+PROGRESS_INTERVAL = 0.1     # second between two progress replies of a job
+
+
+class MacroCache:
+    def __init__(self, layout=None, scan_table=None, size=CACHE_SIZE):
+        """Constructor for a LRU cache of compiled macros.
+
+        Args:
+            layout: monitor.Layout passed to log.Template.
+            scan_table: Scan code table passed to log.Template.
+            size: Maximum number of macros kept in the cache.
+        """
+        self.layout = layout
+        self.scan_table = scan_table
+        self.size = size
+        self.macros = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, filepath) -> log.Template:
+        """Get the compiled macro of a log file.
+
+        The cache is keyed by the hash of the file content, so an edited log
+        is compiled again while copies of a log share one entry.
+
+        Args:
+            filepath: The path to the log file.
+
+        Return:
+            A log.Template of the log file.
+        """
+        with open(filepath, "rb") as f:
+            key = hashlib.sha256(f.read()).hexdigest()
+
+        macro = self.macros.get(key)
+        if macro is not None:
+            self.hits += 1
+            self.macros.move_to_end(key)
+            return macro
+
+        self.misses += 1
+        macro = log.Template(filepath, self.layout, self.scan_table)
+        self.macros[key] = macro
+        if len(self.macros) > self.size:
+            self.macros.popitem(last=False)
+        return macro
+
+    def status(self) -> dict:
+        return {"size": len(self.macros), "hits": self.hits,
+                "misses": self.misses}
+
+
+class Job:
+    def __init__(self, job_id, filepath, repeat_times, variables, reply):
+        """Constructor for a queued play command.
+
+        Args:
+            job_id: Identifier of the job reported to clients.
+            filepath: The path to the log file.
+            repeat_times: Repeat times for actions in the log file.
+            variables: Template variables of the log file.
+            reply: Callable taking a dictionary to be sent to the client.
+        """
+        self.id = job_id
+        self.filepath = filepath
+        self.repeat_times = repeat_times
+        self.variables = variables
+        self.reply = reply
+        self.stopped = False
+
+    def status(self) -> dict:
+        return {"job": self.id, "file": self.filepath,
+                "repeat": self.repeat_times}
+
+
+class Player:
+    def __init__(self, send, cache, sleep=time.sleep, end_key=None,
+                 is_pressed=None):
+        """Constructor for the playback scheduler.
+
+        Jobs are replayed one at a time in the order they are queued. The
+        replay of a job runs in a worker thread with a blocking sleep, which
+        is more precise than the timers of the event loop on Windows, and
+        keeps compiling large logs off the event loop.
+
+        Args:
+            send: Callable taking an INPUT array, e.g. win_utils.send_input.
+            cache: MacroCache providing the compiled macros.
+            sleep: Function waiting for the given seconds.
+            end_key: Virtual-key code stopping the running job.
+            is_pressed: Callable telling if a virtual key is pressed, e.g.
+                win_utils.is_pressed. Required by `end_key`.
+        """
+        self.send = send
+        self.cache = cache
+        self.sleep = sleep
+        self.end_key = end_key
+        self.is_pressed = is_pressed
+        self.queue = asyncio.Queue()
+        self.pending = []
+        self.current = None
+        self.ids = itertools.count(1)
+
+    def play(self, filepath, repeat_times, variables, reply) -> Job:
+        """Queue a play command."""
+        job = Job(next(self.ids), filepath, repeat_times, variables, reply)
+        self.pending.append(job)
+        self.queue.put_nowait(job)
+        job.reply({"job": job.id, "event": "queued",
+                   "position": len(self.pending)})
+        return job
+
+    def stop(self, stop_all=False) -> list:
+        """Stop the running job, and the queued ones if `stop_all` is set.
+
+        Return:
+            Identifiers of the stopped jobs.
+        """
+        jobs = [self.current] if self.current else []
+        if stop_all:
+            jobs += self.pending
+        for job in jobs:
+            job.stopped = True
+        return [job.id for job in jobs]
+
+    def status(self) -> dict:
+        return {
+            "running": self.current.status() if self.current else None,
+            "queued": [job.status() for job in self.pending],
+            "cache": self.cache.status()
+        }
+
+    async def run(self):
+        """Replay the queued jobs forever."""
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            self.pending.remove(job)
+            if job.stopped:
+                job.reply({"job": job.id, "event": "done",
+                           "status": "stopped"})
+                continue
+
+            # Replies of the worker thread are sent from the event loop.
+            reply = job.reply
+            job.reply = lambda msg: loop.call_soon_threadsafe(reply, msg)
+
+            self.current = job
+            try:
+                status = await loop.run_in_executor(None, self._replay, job)
+                reply({"job": job.id, "event": "done", "status": status})
+            except Exception as e:
+                logging.exception("Job {} failed.".format(job.id))
+                reply({"job": job.id, "event": "done", "status": "error",
+                       "error": str(e)})
+            finally:
+                job.stopped = True
+                self.current = None
+
+    def _detect_endkey(self, job):
+        """Poll for the end key until the job is done, like playback.py."""
+        while not job.stopped:
+            time.sleep(0.001)
+            if self.is_pressed(self.end_key):
+                logging.info("Job {} terminated by user.".format(job.id))
+                job.stopped = True
+
+    def _replay(self, job) -> str:
+        """Replay a job in a worker thread and report its progress.
+
+        Return:
+            "finished" or "stopped".
+        """
+        if self.end_key is not None:
+            threading.Thread(
+                target=self._detect_endkey, args=(job,), daemon=True).start()
+
+        macro = self.cache.get(job.filepath).render(job.variables)
+        job.reply({"job": job.id, "event": "start", "total": len(macro)})
+
+        last_report = time.monotonic()
+        for repeat in range(job.repeat_times):
+            for index, (in_arr, waiting_time) in enumerate(macro):
+                if job.stopped:
+                    return "stopped"
+
+                # Wait until the next action is taken.
+                if waiting_time > 0:
+                    self.sleep(waiting_time)
+                if in_arr:
+                    self.send(in_arr)
+
+                now = time.monotonic()
+                if now - last_report >= PROGRESS_INTERVAL:
+                    last_report = now
+                    job.reply({"job": job.id, "event": "progress",
+                               "repeat": repeat, "index": index + 1})
+            job.reply({"job": job.id, "event": "progress",
+                       "repeat": repeat, "index": len(macro)})
+        return "finished"
+
+
+class Server:
+    def __init__(self, player, token):
+        """Constructor for the command server of a Player.
+
+        Args:
+            player: Player replaying the commands.
+            token: Secret every command has to carry.
+        """
+        self.player = player
+        self.token = token
+
+    async def handle(self, reader, writer):
+        """Serve the commands of a client connection."""
+
+        def reply(message):
+            if not writer.is_closing():
+                writer.write((json.dumps(message) + "\n").encode())
+
+        done = set()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                message = json.loads(line)
+                if not hmac.compare_digest(
+                        str(message.get("token", "")), self.token):
+                    reply({"event": "error", "error": "Invalid token."})
+                    break
+                self.dispatch(message, reply, done)
+            except (ValueError, KeyError, TypeError) as e:
+                reply({"event": "error", "error": str(e)})
+            await writer.drain()
+
+        # Keep the connection open until the jobs of the client are done.
+        while done:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+        writer.close()
+
+    def dispatch(self, message, reply, done):
+        """Run a command.
+
+        Args:
+            message: The command sent by the client.
+            reply: Callable taking a dictionary to be sent to the client.
+            done: Set of the client's unfinished jobs.
+        """
+        cmd = message["cmd"]
+        if cmd == "play":
+            def job_reply(msg):
+                reply(msg)
+                if msg["event"] == "done":
+                    done.discard(msg["job"])
+            job = self.player.play(
+                message["file"], int(message.get("repeat", 1)),
+                dict(message.get("vars", {})), job_reply)
+            done.add(job.id)
+        elif cmd == "stop":
+            reply({"event": "stopped",
+                   "jobs": self.player.stop(message.get("all", False))})
+        elif cmd == "status":
+            reply(dict(self.player.status(), event="status"))
+        else:
+            raise ValueError("Unknown command `{}`.".format(cmd))
+
+
+def _split_address(address) -> (str, int):
+    """Split `host:port` of a loopback address."""
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def _private_dir(path):
+    """Create a directory only accessible by the current user.
+
+    PermissionError is raised if the directory exists but another user owns
+    it or can access it, e.g. it was created in advance in the shared
+    temporary directory.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    if os.name == "nt":
+        return
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+            st.st_mode & 0o077:
+        raise PermissionError(
+            "{} must be a directory only accessible by its owner.".format(
+                path))
+
+
+def write_token(filepath) -> str:
+    """Generate a new token and write it to a file readable by the user."""
+    _private_dir(os.path.dirname(filepath))
+    token = secrets.token_hex(32)
+    if os.path.exists(filepath):
+        os.remove(filepath)
+    fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(token)
+    return token
+
+
+def read_token(filepath) -> str:
+    """Read the token written by `write_token()`."""
+    with open(filepath, "r") as f:
+        return f.read().strip()
+
+
+async def serve(address, player, token_file=TOKEN_FILE):
+    """Run the service until cancelled.
+
+    Args:
+        address: The socket path, or `host:port` without Unix sockets.
+        player: Player replaying the commands.
+        token_file: The path the token of the clients is written to.
+    """
+    server = Server(player, write_token(token_file))
+    if UNIX_SOCKET:
+        _private_dir(os.path.dirname(os.path.abspath(address)))
+        if os.path.exists(address):
+            os.remove(address)
+        listener = await asyncio.start_unix_server(server.handle, address)
+        os.chmod(address, 0o600)
+    else:
+        host, port = _split_address(address)
+        listener = await asyncio.start_server(server.handle, host, port)
+    logging.info("Listening on {}.".format(address))
+    async with listener:
+        await asyncio.gather(listener.serve_forever(), player.run())
+
+
+async def request(address, message, token):
+    """Send a command and yield the replies until the command is done.
+
+    Args:
+        address: The socket path, or `host:port` without Unix sockets.
+        message: The command to be sent.
+        token: The token of the service.
+    """
+    message = dict(message, token=token)
+    if UNIX_SOCKET:
+        reader, writer = await asyncio.open_unix_connection(address)
+    else:
+        reader, writer = await asyncio.open_connection(
+            *_split_address(address))
+    writer.write((json.dumps(message) + "\n").encode())
+    await writer.drain()
+    writer.write_eof()
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        yield json.loads(line)
+    writer.close()
+
+
+async def client(address, message, token):
+    """Print the replies of a command."""
+    async for reply in request(address, message, token):
+        print(json.dumps(reply))
+
+
+def parse_arg():
+    """Serve or control the resident playback service."""
+    parser = argparse.ArgumentParser(description=parse_arg.__doc__)
+    parser.add_argument("-a", "--address", type=str, default=DEFAULT_ADDRESS)
+    parser.add_argument("-t", "--token-file", type=str, default=TOKEN_FILE)
+    commands = parser.add_subparsers(dest="cmd", required=True)
+    serve = commands.add_parser("serve")
+    serve.add_argument("-s", "--scancode", action="store_true",
+                       help="replay keys as scan codes")
+    serve.add_argument("-e", "--endkey", type=str, default="LCTRL",
+                       help="key stopping the running job")
+    play = commands.add_parser("play")
+    play.add_argument("-r", "--repeat", type=int, default=1)
+    play.add_argument("-f", "--file", type=str, default="log.txt")
+    play.add_argument("--var", type=str, action="append", default=[],
+                      metavar="NAME=VALUE", help="set a template variable")
+    stop = commands.add_parser("stop")
+    stop.add_argument("--all", action="store_true",
+                      help="also drop the queued jobs")
+    commands.add_parser("status")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(filename)s:%(lineno)d][%(levelname)s] %(message)s")
+
+    args = parse_arg()
+    if args.cmd == "serve":
+        import win_const
+        import win_utils
+        scan_table = None
+        if args.scancode:
+            scan_table = log.build_scan_table(win_utils.map_virtual_key)
+        cache = MacroCache(win_utils.get_monitor_layout(), scan_table)
+        player = Player(
+            win_utils.send_input, cache,
+            end_key=win_const.VIRTUAL_KEYS_REVERSE[args.endkey],
+            is_pressed=win_utils.is_pressed)
+        try:
+            asyncio.run(serve(args.address, player, args.token_file))
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    if args.cmd == "play":
+        # The service may run in another working directory.
+        message = {"cmd": "play", "file": os.path.abspath(args.file),
+                   "repeat": args.repeat,
+                   "vars": dict(var.split("=", 1) for var in args.var)}
+    elif args.cmd == "stop":
+        message = {"cmd": "stop", "all": args.all}
+    else:
+        message = {"cmd": "status"}
+    asyncio.run(client(args.address, message, read_token(args.token_file)))
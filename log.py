@@ -1,25 +1,33 @@
 """
 log.py - Read/Write mouse/keyboard event from/to a file.
 """
+import os
 import json
+import time
+import string
 import logging
+import itertools
+import threading
+from array import array
+from ctypes import addressof, memmove, sizeof
 from datetime import datetime, timedelta
 
+import monitor
 import win_utils
 from win_const import *
 
 DOWN_UP_DELAY = 0.001   # second
 
-KEYBOARD_MSGS = {
+KEYBOARD_MSGS = frozenset({
     WM_KEYDOWN, WM_KEYUP,
     WM_SYSKEYDOWN, WM_SYSKEYUP
-}
+})
 
-MOUSE_MSGS = {
+MOUSE_MSGS = frozenset({
     WM_MOUSEMOVE,
     WM_LBUTTONDOWN, WM_LBUTTONUP,
     WM_RBUTTONDOWN, WM_RBUTTONUP
-}
+})
 
 MSG_TO_LOG = {
     WM_KEYDOWN: "KeyDown",
@@ -45,23 +53,23 @@ MSG_TO_MOUSE_EVENT = {
     WM_RBUTTONUP: MOUSEEVENTF_RIGHTUP
 }
 
-CTRL_KEYS = {
+CTRL_KEYS = frozenset({
     VIRTUAL_KEYS_REVERSE["CTRL"],
     VIRTUAL_KEYS_REVERSE["LCTRL"],
     VIRTUAL_KEYS_REVERSE["RCTRL"]
-}
+})
 
-SHIFT_KEYS = {
+SHIFT_KEYS = frozenset({
     VIRTUAL_KEYS_REVERSE["SHIFT"],
     VIRTUAL_KEYS_REVERSE["LSHFT"],
     VIRTUAL_KEYS_REVERSE["RSHFT"]
-}
+})
 
-ALT_KEYS = {
+ALT_KEYS = frozenset({
     VIRTUAL_KEYS_REVERSE["ALT"],
     VIRTUAL_KEYS_REVERSE["LALT"],
     VIRTUAL_KEYS_REVERSE["RALT"]
-}
+})
 
 if not set(MSG_TO_LOG).issuperset(KEYBOARD_MSGS):
     raise Exception(
@@ -73,11 +81,26 @@ if not set(MSG_TO_LOG).issuperset(MOUSE_MSGS):
 
 
 class Writer:
-    def __init__(self, filepath, end_key):
-        """Constructor for opening the log file."""
-        self.file = open(filepath, "w")
+    def __init__(self, filepath, end_key, layout=None, injected_only=False):
+        """Constructor for opening the log file.
+
+        Args:
+            filepath: The path to the log file.
+            end_key: Virtual-key code terminating the recording.
+            layout: monitor.Layout used to normalize mouse coordinates.
+                The current layout is captured if not given.
+            injected_only: Log the events synthesized by SendInput only.
+        """
         self.last_time = None
-        self.first_key = True
+        self.injected_only = injected_only
+
+        # The first key up is the release of the key starting the recording,
+        # which is never among the events synthesized by SendInput.
+        self.first_key = not injected_only
+
+        # Capture the monitor layout once instead of querying the screen
+        # resolution on every mouse event.
+        self.layout = layout or win_utils.get_monitor_layout()
 
         # There may be two ALT, CTRL, and SHIFT keys on the keyboard.
         if end_key in CTRL_KEYS:
@@ -89,6 +112,17 @@ class Writer:
         else:
             self.end_keys = {end_key}
 
+        self.file = self._open(filepath)
+
+    def _open(self, filepath, mode="w"):
+        """Open the log file and write the monitor layout."""
+        file = open(filepath, mode)
+        file.write(json.dumps({
+            "MONITORS": self.layout.to_log(),
+            "WAITING_TIME": 0
+        }) + "\n")
+        return file
+
     def _waiting_time(self) -> float:
         """Reterive the waiting time in seconds since last logged event."""
         waiting_time = 0
@@ -136,6 +170,8 @@ class Writer:
         kb = KBDLLHOOKSTRUCT.from_address(lParam)
         if kb.vkCode not in VIRTUAL_KEYS:
             return False
+        if self.injected_only and not kb.flags & LLKHF_INJECTED:
+            return False
 
         # Exclude the end keys
         if kb.vkCode in self.end_keys:
@@ -146,11 +182,18 @@ class Writer:
             self.first_key = False
             return False
 
+        self._keyboard_event(wParam, kb.vkCode, kb.scanCode,
+                             kb.flags & LLKHF_EXTENDED)
+        return True
+
+    def _keyboard_event(self, wParam, vk, scan, extended):
+        """Write an accepted keyboard event to the file."""
         log = {
-            MSG_TO_LOG[wParam]: VIRTUAL_KEYS[kb.vkCode]
+            MSG_TO_LOG[wParam]: VIRTUAL_KEYS[vk],
+            "scan": scan,
+            "ext": bool(extended)
         }
         self._write(log)
-        return True
 
     def mousell_msg(self, wParam, lParam) -> bool:
         """Write low level mouse message to the file.
@@ -167,9 +210,14 @@ class Writer:
             return False
 
         mouse = MSLLHOOKSTRUCT.from_address(lParam)
-        x, y = win_utils.normalized_screen_coordinates(
-            mouse.pt.x, mouse.pt.y)
+        if self.injected_only and not mouse.flags & LLMHF_INJECTED:
+            return False
+        x, y = self.layout.normalize(mouse.pt.x, mouse.pt.y)
+        self._mouse_event(wParam, x, y)
+        return True
 
+    def _mouse_event(self, wParam, x, y):
+        """Write an accepted mouse event to the file."""
         # TODO: Bunch of mousemove messages are logged.
         log = {
             "x": x,
@@ -177,17 +225,198 @@ class Writer:
             MSG_TO_LOG[wParam]: True
         }
         self._write(log)
-        return True
 
     def __del__(self):
         """Destructor for closing the log file."""
-        self.file.close()
+        if self.file:
+            self.file.close()
+
+
+class RingWriter(Writer):
+    def __init__(self, filepath, end_key, capacity, layout=None,
+                 window=None, dump_key=None):
+        """Constructor for keeping the latest events in memory.
+
+        Events are stored in arrays preallocated for `capacity` events, and
+        the oldest event is overwritten when the buffer is full, so the
+        memory use does not grow with the length of the recording. Nothing
+        is written until dump() is called.
+
+        Args:
+            filepath: The path to the log file. Dumps are written next to
+                it with a timestamp suffix.
+            end_key: Virtual-key code terminating the recording.
+            capacity: Maximum number of events kept in the buffer.
+            layout: monitor.Layout used to normalize mouse coordinates.
+            window: Dump only the events of the last `window` seconds.
+            dump_key: Virtual-key code triggering a dump when pressed.
+        """
+        self.capacity = capacity
+        self.window = window
+        self.dump_key = dump_key
+        self.dump_key_down = False
+        self.dump_requested = False
+        self.dump_thread = None
+
+        # One slot per event: time, message, and message dependent values.
+        # Keyboard: virtual-key code, scan code and extended flag.
+        # Mouse: normalized x and y.
+        # Wait: message 0 marking the end of a recording.
+        self.times = array("d", [0.0]) * capacity
+        self.msgs = array("H", [0]) * capacity
+        self.values = array("i", [0]) * (2 * capacity)
+        self.flags = array("B", [0]) * capacity
+        self.head = 0
+        self.count = 0
+
+        super().__init__(filepath, end_key, layout)
+
+    def _open(self, filepath):
+        """Keep the path for dumps instead of opening the file."""
+        self.filepath = filepath
+        return None
+
+    def _store(self, msg, value1, value2, flag):
+        """Store an event into the buffer overwriting the oldest one."""
+        i = self.head
+        self.times[i] = time.monotonic()
+        self.msgs[i] = msg
+        self.values[2 * i] = value1
+        self.values[2 * i + 1] = value2
+        self.flags[i] = flag
+        self.head = i + 1 if i + 1 < self.capacity else 0
+        if self.count < self.capacity:
+            self.count += 1
+
+        # Dumps requested by signal handlers are done between two events so
+        # the buffer is never dumped half-written.
+        if self.dump_requested:
+            self.dump()
+
+    def wait_event(self):
+        self._store(0, 0, 0, 0)
+
+    def _keyboard_event(self, wParam, vk, scan, extended):
+        if vk == self.dump_key:
+            # Ignore the auto-repeat of a held dump key.
+            down = wParam == WM_KEYDOWN or wParam == WM_SYSKEYDOWN
+            if down and not self.dump_key_down:
+                self.dump()
+            self.dump_key_down = down
+            return
+        self._store(wParam, vk, scan, 1 if extended else 0)
+
+    def _mouse_event(self, wParam, x, y):
+        self._store(wParam, x, y, 0)
+
+    def request_dump(self):
+        """Dump the buffer on the next event, e.g. from a signal handler."""
+        self.dump_requested = True
+
+    def dump(self, filepath=None) -> threading.Thread:
+        """Write the buffered events to a log file in the usual format.
+
+        Dumps are triggered inside the hook procedure, which has to return
+        within LowLevelHooksTimeout or Windows removes the hook. So only a
+        copy of the buffer is taken here, and the file is written by a new
+        thread. A request made while the previous dump is still written is
+        postponed to the next event, so at most one copy of the buffer is
+        kept.
+
+        Args:
+            filepath: The path to the log file. By default the path given to
+                the constructor with a timestamp suffix.
+
+        Return:
+            The thread writing the log file.
+        """
+        if self.dump_thread is not None and self.dump_thread.is_alive():
+            self.dump_requested = True
+            return self.dump_thread
+
+        self.dump_requested = False
+        first = (self.head - self.count) % self.capacity
+        self.dump_thread = threading.Thread(target=self._write_dump, args=(
+            filepath, time.monotonic(), first, self.count, self.times[:],
+            self.msgs[:], self.values[:], self.flags[:]))
+        self.dump_thread.start()
+        return self.dump_thread
+
+    def _open_dump(self):
+        """Open a new file named after the current time for a dump."""
+        root, ext = os.path.splitext(self.filepath)
+        now = datetime.now()
+        stamp = "{}-{:03d}".format(
+            now.strftime("%Y%m%d-%H%M%S"), now.microsecond // 1000)
+        # Never overwrite the dumps done in the same millisecond.
+        for n in itertools.count():
+            suffix = "-{}".format(n) if n else ""
+            try:
+                return Writer._open(
+                    self, "{}-{}{}{}".format(root, stamp, suffix, ext), "x")
+            except FileExistsError:
+                pass
+
+    def _write_dump(self, filepath, now, first, count, times, msgs, values,
+                    flags):
+        """Write a copy of the buffer taken by dump() at `now`."""
+        slots = [(first + n) % self.capacity for n in range(count)]
+        if self.window is not None:
+            slots = [i for i in slots if times[i] >= now - self.window]
+
+        file = Writer._open(self, filepath) if filepath else self._open_dump()
+        with file:
+            last_time = None
+            for i in slots:
+                msg = msgs[i]
+                value1, value2 = values[2 * i], values[2 * i + 1]
+                if msg in KEYBOARD_MSGS:
+                    log = {
+                        MSG_TO_LOG[msg]: VIRTUAL_KEYS[value1],
+                        "scan": value2,
+                        "ext": bool(flags[i])
+                    }
+                elif msg in MOUSE_MSGS:
+                    log = {"x": value1, "y": value2, MSG_TO_LOG[msg]: True}
+                else:
+                    log = {}
+                log["WAITING_TIME"] = 0 if last_time is None \
+                    else times[i] - last_time
+                last_time = times[i]
+                file.write(json.dumps(log) + "\n")
+
+        logging.info("Dump {} events to {}.".format(len(slots), file.name))
 
 
 class Reader:
-    def __init__(self, filepath):
-        """Constructor for opening the file."""
+    def __init__(self, filepath, layout=None, scan_table=None):
+        """Constructor for opening the file.
+
+        Args:
+            filepath: The path to the log file.
+            layout: monitor.Layout of the playback machine. Mouse events are
+                remapped to it if the log was recorded on another layout.
+            scan_table: Table built by build_scan_table(). Keys are replayed
+                as scan codes instead of virtual-key codes if given.
+        """
         self.file = open(filepath, "r")
+        self.layout = layout
+        self.scan_table = scan_table
+
+        # Logs without the monitor layout are normalized against the primary
+        # monitor, so they are replayed without MOUSEEVENTF_VIRTUALDESK.
+        self.virtual_desk = False
+        self.transform = None
+
+    def _set_source_layout(self, logs: dict):
+        """Prepare the coordinate mapping from the recorded layout."""
+        source = monitor.Layout.from_log(logs["MONITORS"])
+        self.virtual_desk = True
+        self.transform = None
+        if self.layout and self.layout != source:
+            logging.info("Remap mouse events from {} to {}.".format(
+                source, self.layout))
+            self.transform = monitor.Transform(source, self.layout)
 
     def _get_keyboard_msg(self, logs: dict):
         """Get keyboard message from logs."""
@@ -214,10 +443,21 @@ class Reader:
         # Simulate for key down-up with reasonable delay.
         in_arr = (INPUT * 1)()
         in_arr[0].type = INPUT_KEYBOARD
-        in_arr[0].u.ki.wVk = VIRTUAL_KEYS_REVERSE[logs[MSG_TO_LOG[msg]]]
+        vk = VIRTUAL_KEYS_REVERSE[logs[MSG_TO_LOG[msg]]]
+        in_arr[0].u.ki.wVk = vk
         if msg == WM_KEYUP or msg == WM_SYSKEYUP:
             in_arr[0].u.ki.dwFlags = KEYEVENTF_KEYUP
 
+        if self.scan_table is not None:
+            # Prefer the scan code of the recording over the table, which
+            # only covers the keyboard layout of this machine.
+            scan, extended = self.scan_table.get(vk, (0, False))
+            if logs.get("scan"):
+                scan, extended = logs["scan"], logs.get("ext", False)
+            if scan:
+                in_arr[0].u.ki.wScan = scan
+                in_arr[0].u.ki.dwFlags |= scan_flags(extended)
+
         return in_arr
 
     def _mouse_msg(self, logs: dict):
@@ -229,8 +469,13 @@ class Reader:
         # Simulate for click down-up with reasonable delay.
         in_arr = (INPUT * 1)()
         in_arr[0].type = INPUT_MOUSE
-        in_arr[0].u.mi.dx, in_arr[0].u.mi.dy = logs["x"], logs["y"]
+        x, y = logs["x"], logs["y"]
+        if self.transform:
+            x, y = self.transform.apply(x, y)
+        in_arr[0].u.mi.dx, in_arr[0].u.mi.dy = x, y
         flag = MOUSEEVENTF_ABSOLUTE
+        if self.virtual_desk:
+            flag = flag | MOUSEEVENTF_VIRTUALDESK
         for m, log in MSG_TO_LOG.items():
             if log in logs:
                 flag = flag | MSG_TO_MOUSE_EVENT[m]
@@ -247,50 +492,32 @@ class Reader:
 
         Return:
             An array of INPUT structures which will be consumed by
-            user32.SendInput() API.
+            user32.SendInput() API, or a TextTemplate for a `Text` line
+            which is expanded by Template.render().
         """
         for line in self.file:
             logs = json.loads(line)
 
+            if "MONITORS" in logs:
+                self._set_source_layout(logs)
+
             empty_event = True
 
+            # Compile typed text, which may contain template variables
+            if "Text" in logs:
+                empty_event = False
+                yield TextTemplate(logs["Text"]), logs["WAITING_TIME"]
+
             # Generate keyboard event from logs
             in_arr = self._keyboard_msg(logs)
             if in_arr:
                 empty_event = False
-                # Generate running status
-                act = "down"
-                if in_arr[0].u.ki.dwFlags & KEYEVENTF_KEYUP:
-                    act = "up"
-                sts = "Key `{key}` {act} in {sec:.2f} sec.".format(
-                    key=VIRTUAL_KEYS[in_arr[0].u.ki.wVk],
-                    act=act,
-                    sec=logs["WAITING_TIME"]
-                )
-                logging.info(sts)
                 yield in_arr, logs["WAITING_TIME"]
 
             # Generate mouse event from logs
             in_arr = self._mouse_msg(logs)
             if in_arr:
                 empty_event = False
-                # Generate running status
-                act = "mouse "
-                if in_arr[0].u.mi.dwFlags & MOUSEEVENTF_MOVE:
-                    act += "move "
-                if in_arr[0].u.mi.dwFlags & MOUSEEVENTF_LEFTDOWN:
-                    act += "left down"
-                if in_arr[0].u.mi.dwFlags & MOUSEEVENTF_LEFTUP:
-                    act += "left up"
-                if in_arr[0].u.mi.dwFlags & MOUSEEVENTF_RIGHTDOWN:
-                    act += "right down "
-                if in_arr[0].u.mi.dwFlags & MOUSEEVENTF_RIGHTUP:
-                    act += "right up "
-                sts = "{act} in {sec:.2f} sec.".format(
-                    act=act,
-                    sec=logs["WAITING_TIME"]
-                )
-                logging.info(sts)
                 yield in_arr, logs["WAITING_TIME"]
 
             # Neither mouse nor keyboard event
@@ -300,3 +527,210 @@ class Reader:
     def __del__(self):
         """Destructor to close the file."""
         self.file.close()
+
+
+def describe(in_arr):
+    """Generate the running status of a step generated by Reader.
+
+    Args:
+        in_arr: An array of INPUT structures, a TextTemplate or None.
+
+    Return:
+        A description of the action, or None for an empty event.
+    """
+    if isinstance(in_arr, TextTemplate):
+        # The template is shown instead of the values, which may be secret.
+        return "Text `{}`".format(in_arr.text)
+    if not in_arr:
+        return None
+
+    if in_arr[0].type == INPUT_KEYBOARD:
+        act = "down"
+        if in_arr[0].u.ki.dwFlags & KEYEVENTF_KEYUP:
+            act = "up"
+        return "Key `{key}` {act}".format(
+            key=VIRTUAL_KEYS[in_arr[0].u.ki.wVk], act=act)
+
+    act = "mouse "
+    if in_arr[0].u.mi.dwFlags & MOUSEEVENTF_MOVE:
+        act += "move "
+    if in_arr[0].u.mi.dwFlags & MOUSEEVENTF_LEFTDOWN:
+        act += "left down"
+    if in_arr[0].u.mi.dwFlags & MOUSEEVENTF_LEFTUP:
+        act += "left up"
+    if in_arr[0].u.mi.dwFlags & MOUSEEVENTF_RIGHTDOWN:
+        act += "right down "
+    if in_arr[0].u.mi.dwFlags & MOUSEEVENTF_RIGHTUP:
+        act += "right up "
+    return act
+
+
+def decode_scan_code(code) -> (int, bool):
+    """Split the result of MapVirtualKey with MAPVK_VK_TO_VSC_EX.
+
+    Args:
+        code: Scan code with the 0xE0 or 0xE1 prefix in the high byte.
+
+    Return:
+        scan, extended: The scan code for KEYBDINPUT.wScan and whether
+        KEYEVENTF_EXTENDEDKEY is required.
+    """
+    return code & 0xFF, (code >> 8) in (0xE0, 0xE1)
+
+
+def scan_flags(extended) -> int:
+    """Get KEYBDINPUT.dwFlags for replaying a scan code."""
+    if extended:
+        return KEYEVENTF_SCANCODE | KEYEVENTF_EXTENDEDKEY
+    return KEYEVENTF_SCANCODE
+
+
+def build_scan_table(map_virtual_key) -> dict:
+    """Build the table from virtual-key codes to scan codes.
+
+    The table is built once, so replaying does not call MapVirtualKey for
+    every event.
+
+    Args:
+        map_virtual_key: Callable translating a virtual-key code such as
+            win_utils.map_virtual_key.
+
+    Return:
+        A dictionary mapping the virtual-key codes of VIRTUAL_KEYS to
+        (scan, extended) tuples. Keys without a scan code are left out.
+    """
+    table = {}
+    for vk in VIRTUAL_KEYS:
+        code = map_virtual_key(vk)
+        if code:
+            table[vk] = decode_scan_code(code)
+    return table
+
+
+def unicode_input_array(text):
+    """Generate keyboard INPUT array typing a text.
+
+    Every UTF-16 code unit is sent as a key down and a key up with
+    KEYEVENTF_UNICODE, so any character can be typed regardless of the
+    keyboard layout.
+    https://docs.microsoft.com/en-us/windows/win32/api/winuser/ns-winuser-keybdinput
+
+    Args:
+        text: The text to be typed.
+
+    Return:
+        An array of INPUT structures.
+    """
+    units = array("H", text.encode("utf-16-le"))
+    in_arr = (INPUT * (2 * len(units)))()
+    for i, unit in enumerate(units):
+        for j, flags in ((2 * i, KEYEVENTF_UNICODE),
+                         (2 * i + 1, KEYEVENTF_UNICODE | KEYEVENTF_KEYUP)):
+            in_arr[j].type = INPUT_KEYBOARD
+            in_arr[j].u.ki.wScan = unit
+            in_arr[j].u.ki.dwFlags = flags
+    return in_arr
+
+
+class TextTemplate:
+    def __init__(self, text):
+        """Constructor for compiling a text with template variables.
+
+        The text uses the str.format() syntax, e.g. "Hello {user}!". The
+        literal parts are converted to INPUT arrays here, so rendering only
+        converts the values of the variables.
+
+        Args:
+            text: The text of a `Text` line in the log file.
+        """
+        self.text = text
+        self.formatter = string.Formatter()
+        self.parts = []
+        self.fields = set()
+        for literal, field, spec, conversion in self.formatter.parse(text):
+            if literal:
+                self.parts.append(unicode_input_array(literal))
+            if field is not None:
+                # The variable name of fields such as "user.name".
+                name = field.split(".")[0].split("[")[0]
+                # Unnamed and positional fields such as "{}" and "{0}" are
+                # looked up in the positional arguments, which are never
+                # given.
+                if not name.isidentifier():
+                    raise ValueError(
+                        "Unnamed or positional field in text `{}`.".format(
+                            text))
+                self.parts.append((field, spec, conversion))
+                self.fields.add(name)
+
+    def render(self, variables: dict):
+        """Generate keyboard INPUT array with the variables substituted.
+
+        Args:
+            variables: Values of the template variables.
+
+        Return:
+            An array of INPUT structures.
+        """
+        arrays = []
+        for part in self.parts:
+            if isinstance(part, tuple):
+                field, spec, conversion = part
+                value, _ = self.formatter.get_field(field, (), variables)
+                value = self.formatter.convert_field(value, conversion)
+                part = unicode_input_array(
+                    self.formatter.format_field(value, spec))
+            arrays.append(part)
+        if len(arrays) == 1:
+            return arrays[0]
+
+        in_arr = (INPUT * sum(len(a) for a in arrays))()
+        offset = 0
+        for a in arrays:
+            memmove(addressof(in_arr) + offset, a, sizeof(a))
+            offset += sizeof(a)
+        return in_arr
+
+
+class Template:
+    def __init__(self, filepath, layout=None, scan_table=None):
+        """Constructor for compiling a log file once for many runs.
+
+        Args:
+            filepath: The path to the log file.
+            layout: monitor.Layout of the playback machine.
+            scan_table: See Reader.
+        """
+        reader = Reader(filepath, layout, scan_table)
+        self.steps = list(reader.get_next_input_array())
+        self.fields = set()
+        for in_arr, _ in self.steps:
+            if isinstance(in_arr, TextTemplate):
+                self.fields |= in_arr.fields
+
+    def __len__(self):
+        return len(self.steps)
+
+    def check(self, variables=None):
+        """Raise KeyError if a template variable is not given a value."""
+        missing = self.fields - set(variables or {})
+        if missing:
+            raise KeyError("Missing template variables: {}".format(
+                ", ".join(sorted(missing))))
+
+    def render(self, variables=None) -> list:
+        """Materialize the template variables of a run.
+
+        Args:
+            variables: Values of the template variables.
+
+        Return:
+            A list of (INPUT array or None, waiting time) tuples.
+        """
+        variables = variables or {}
+        self.check(variables)
+        return [
+            (in_arr.render(variables), waiting_time)
+            if isinstance(in_arr, TextTemplate) else (in_arr, waiting_time)
+            for in_arr, waiting_time in self.steps
+        ]
@@ -0,0 +1,183 @@
+"""
+monitor.py - Map mouse coordinates across multi-monitor virtual desktops.
+
+The module only does arithmetic on monitor rectangles so that it can be used
+without the Windows API. The layout itself is captured by
+`win_utils.get_monitor_layout()`.
+"""
+from bisect import bisect_right
+from collections import namedtuple
+
+# The absolute coordinates used by SendInput are normalized to 0-65535.
+# https://docs.microsoft.com/en-us/windows/win32/api/winuser/ns-winuser-mouseinput
+NORMALIZED_MAX = 65536
+
+# A monitor rectangle in virtual screen coordinates. `right` and `bottom` are
+# exclusive as in the RECT returned by GetMonitorInfo.
+Monitor = namedtuple("Monitor", ["left", "top", "right", "bottom", "primary"])
+
+
+class Layout:
+    def __init__(self, monitors):
+        """Constructor for a monitor layout.
+
+        The monitors are sorted with the primary monitor first and the rest
+        from left to right, top to bottom, so that two captures of the same
+        layout always compare equal and monitors can be paired by index.
+
+        Args:
+            monitors: An iterable of Monitor or (left, top, right, bottom,
+                primary) tuples.
+        """
+        monitors = [Monitor(*m) for m in monitors]
+        if not monitors:
+            raise ValueError("A layout requires at least one monitor.")
+        self.monitors = tuple(sorted(
+            monitors, key=lambda m: (not m.primary, m.left, m.top)))
+
+        # Bounding box of all monitors, i.e. the virtual screen.
+        self.left = min(m.left for m in self.monitors)
+        self.top = min(m.top for m in self.monitors)
+        self.width = max(m.right for m in self.monitors) - self.left
+        self.height = max(m.bottom for m in self.monitors) - self.top
+
+        # Split the virtual screen into a grid on every monitor edge. Each
+        # cell belongs to at most one monitor, so a point is located with
+        # two binary searches instead of a MonitorFromPoint call per event.
+        self.xs = sorted({e for m in self.monitors for e in (m.left, m.right)})
+        self.ys = sorted({e for m in self.monitors for e in (m.top, m.bottom)})
+        self.cells = [[None] * (len(self.xs) - 1)
+                      for _ in range(len(self.ys) - 1)]
+        for index, m in enumerate(self.monitors):
+            for row in range(self.ys.index(m.top), self.ys.index(m.bottom)):
+                for col in range(self.xs.index(m.left),
+                                 self.xs.index(m.right)):
+                    self.cells[row][col] = index
+
+    def __eq__(self, other):
+        return isinstance(other, Layout) and self.monitors == other.monitors
+
+    def __hash__(self):
+        return hash(self.monitors)
+
+    def __repr__(self):
+        return "Layout({!r})".format(list(self.monitors))
+
+    def to_log(self) -> list:
+        """Serialize the layout into a JSON friendly list."""
+        return [list(m) for m in self.monitors]
+
+    @classmethod
+    def from_log(cls, monitors):
+        """Deserialize the layout generated by `to_log()`."""
+        return cls(tuple(m) for m in monitors)
+
+    def monitor_index(self, x, y) -> int:
+        """Find the monitor containing a point in O(log n).
+
+        Args:
+            x: x-axis on virtual screen coordinates.
+            y: y-axis on virtual screen coordinates.
+
+        Return:
+            Index of the monitor in `monitors`. Points outside of all
+            monitors fall back to the primary monitor like
+            MONITOR_DEFAULTTOPRIMARY.
+        """
+        col = bisect_right(self.xs, x) - 1
+        row = bisect_right(self.ys, y) - 1
+        if 0 <= row < len(self.cells) and 0 <= col < len(self.cells[row]):
+            index = self.cells[row][col]
+            if index is not None:
+                return index
+        return 0
+
+    def normalize(self, x, y) -> (int, int):
+        """Normalize a point to absolute coordinates on the virtual desktop.
+
+        The result is meant to be replayed with MOUSEEVENTF_VIRTUALDESK.
+
+        Args:
+            x: x-axis on virtual screen coordinates.
+            y: y-axis on virtual screen coordinates.
+
+        Return:
+            x, y: Normalized x, y from 0 to 65535
+        """
+        return (int((x - self.left) * NORMALIZED_MAX / self.width),
+                int((y - self.top) * NORMALIZED_MAX / self.height))
+
+    def denormalize(self, x, y) -> (float, float):
+        """Reverse of `normalize()`."""
+        return (x * self.width / NORMALIZED_MAX + self.left,
+                y * self.height / NORMALIZED_MAX + self.top)
+
+
+class Transform:
+    def __init__(self, source: Layout, target: Layout):
+        """Constructor for remapping normalized points between layouts.
+
+        The i-th monitor of the source layout is mapped to the i-th monitor
+        of the target layout, and monitors without a counterpart are mapped
+        to the target primary monitor. For every source monitor an affine
+        transform `out = scale * in + offset` in normalized coordinates is
+        precomputed, so remapping an event is a table lookup plus two
+        multiply-adds.
+
+        Args:
+            source: The layout the log was recorded on.
+            target: The layout the log is replayed on.
+        """
+        self.source = source
+        self.target = target
+        self.half_x = NORMALIZED_MAX / source.width / 2
+        self.half_y = NORMALIZED_MAX / source.height / 2
+        self.table = []
+        for index, src in enumerate(source.monitors):
+            dst = target.monitors[index] \
+                if index < len(target.monitors) else target.monitors[0]
+            self.table.append(
+                _axis_transform(src.left, src.right, source.left,
+                                source.width, dst.left, dst.right,
+                                target.left, target.width) +
+                _axis_transform(src.top, src.bottom, source.top,
+                                source.height, dst.top, dst.bottom,
+                                target.top, target.height))
+
+    def apply(self, x, y) -> (int, int):
+        """Remap a normalized point from the source to the target layout.
+
+        Args:
+            x: Normalized x on the source virtual desktop.
+            y: Normalized y on the source virtual desktop.
+
+        Return:
+            x, y: Normalized x, y on the target virtual desktop.
+        """
+        # normalize() truncates, so the point lies up to one normalized unit
+        # before the recorded pixel. Map the middle of the pixel instead, or
+        # pixels on the left and top edges fall onto the neighbour monitor,
+        # either when looking up the source or when replaying on the target.
+        x += self.half_x
+        y += self.half_y
+        index = self.source.monitor_index(*self.source.denormalize(x, y))
+        sx, ox, sy, oy = self.table[index]
+        return int(sx * x + ox), int(sy * y + oy)
+
+
+def _axis_transform(src_lo, src_hi, src_origin, src_size,
+                    dst_lo, dst_hi, dst_origin, dst_size) -> (float, float):
+    """Compute scale and offset mapping one monitor axis onto another.
+
+    Both the input and the output are normalized against their own virtual
+    desktop, so the pixel mapping is folded together with the two
+    normalizations.
+    """
+    # Pixel mapping: dst = dst_lo + (src - src_lo) * ratio
+    ratio = (dst_hi - dst_lo) / (src_hi - src_lo)
+    # src = n * src_size / MAX + src_origin
+    # out = (dst - dst_origin) * MAX / dst_size
+    scale = ratio * src_size / dst_size
+    offset = (dst_lo - dst_origin +
+              (src_origin - src_lo) * ratio) * NORMALIZED_MAX / dst_size
+    return scale, offset
@@ -3,28 +3,36 @@ playback.py - Replay the keystokes/mouse clicks behaviors for Windows system.
 
 Example:
     $ python playback.py --repeat 10 --file log.txt
+
+    # Log the input stream during playback and compare it with the source.
+    $ python playback.py --file log.txt --verify verify.txt
+
+    # Replay a log with `Text` lines such as {"Text": "{user}"} once for
+    # every row of a CSV file whose header names the variables.
+    $ python playback.py --repeat 1 --file login.txt --vars-file users.csv
 """
 import log
+import csv
+import verify
 import time
 import argparse
 import logging
 import threading
 from ctypes import (
-    windll, c_int, c_ulonglong, sizeof, GetLastError
+    c_ulonglong, byref
 )
 
 from win_const import *
 from win_utils import *
 
-# Shorthand for the required dll librairies
-user32 = windll.user32
-kernel32 = windll.kernel32
-
 # Termination condition
 END_KEY = None
 END_KEY_PRESSED = False
 ALL_DONE = False
 
+# Thread running the message loop of the verification hooks
+STREAM_THREAD_ID = None
+
 
 def detect_endkey():
     """Poll for the end key."""
@@ -34,38 +42,99 @@ def detect_endkey():
         END_KEY_PRESSED = is_pressed(END_KEY)
 
 
-def playback(filepath, repeat_times=1):
+def record_stream(writer, ready):
+    """Log the input stream synthesized by playback.
+
+    The same low-level hooks and log writer as record.py are used, so the
+    result can be compared with the source log. The hooks run until WM_QUIT
+    is posted to STREAM_THREAD_ID.
+
+    Args:
+        writer: log.Writer of the observed stream, created with
+            `injected_only`.
+        ready: threading.Event set once the hooks are installed, or failed
+            to be installed. STREAM_THREAD_ID is only set on success.
+    """
+    global STREAM_THREAD_ID
+
+    def hook_procedure(nCode, wParam, lParam):
+        if nCode == HC_ACTION:
+            if not writer.keyboardll_msg(wParam, lParam):
+                writer.mousell_msg(wParam, lParam)
+        return user32.CallNextHookEx(
+            None, nCode, wParam, c_ulonglong(lParam))
+
+    kb_handle = mouse_handle = None
+    try:
+        ptr = HOOKPROC(hook_procedure)
+        kb_handle = install_hook(WH_KEYBOARD_LL, ptr)
+        mouse_handle = install_hook(WH_MOUSE_LL, ptr)
+        if kb_handle and mouse_handle:
+            STREAM_THREAD_ID = kernel32.GetCurrentThreadId()
+    finally:
+        # Never leave the main thread waiting, even on failures.
+        ready.set()
+    if STREAM_THREAD_ID is None:
+        uninstall_hook(kb_handle)
+        uninstall_hook(mouse_handle)
+        writer.file.close()
+        return
+
+    # Low-level hooks are called through the message loop of this thread.
+    msg = MSG()
+    while user32.GetMessageA(byref(msg), 0, 0, 0) > 0:
+        pass
+
+    uninstall_hook(kb_handle)
+    uninstall_hook(mouse_handle)
+    writer.file.close()
+
+
+def playback(filepath, repeat_times=1, layout=None, variants=None,
+             scan_table=None):
     """Repeat the keystrokes and mouse clicks behaviors from a log file.
 
     Args:
-        filepath: The path to the log file.
+        filepath: The path to the log file, or a log.Template compiled
+            from it.
         repeat_times: Repeat times for actions in the log file.
+        layout: monitor.Layout of this machine for remapping mouse events.
+        variants: A list of template variables. The log is replayed
+            `repeat_times` for each of them.
+        scan_table: Table of log.build_scan_table() for replaying keys as
+            scan codes.
     """
-    for i in reversed(range(repeat_times)):
+    # Parse the log once and only substitute the variables for each run.
+    template = filepath if isinstance(filepath, log.Template) \
+        else log.Template(filepath, layout, scan_table)
+    runs = [
+        (variables, i)
+        for variables in (variants or [{}])
+        for i in reversed(range(repeat_times))
+    ]
+    for variables, i in runs:
         if END_KEY_PRESSED:
             logging.info("Teminate by user.")
             return
 
         logging.info("{} repeat times remained.".format(i))
-        reader = log.Reader(filepath)
-        for in_arr, waiting_time in reader.get_next_input_array():
+        status = logging.getLogger().isEnabledFor(logging.INFO)
+        steps = zip(template.render(variables), template.steps)
+        for (in_arr, waiting_time), (source, _) in steps:
             if END_KEY_PRESSED:
                 logging.info("Teminate by user.")
                 return
 
+            # Generate running status
+            sts = status and log.describe(source)
+            if sts:
+                logging.info("{} in {:.2f} sec.".format(sts, waiting_time))
+
             # Wait until the next action is taken.
             time.sleep(waiting_time)
 
-            # Synthesizes keystrokes, mouse motions, and button clicks.
-            # https://docs.microsoft.com/en-us/windows/win32/api/winuser/nf-winuser-sendinput
             if in_arr:
-                nums = user32.SendInput(
-                    len(in_arr),
-                    in_arr,
-                    c_int(sizeof(INPUT))
-                )
-                if nums < len(in_arr):
-                    raise OSError(GetLastError())
+                send_input(in_arr)
 
 
 def parse_arg():
@@ -74,9 +143,35 @@ def parse_arg():
     parser.add_argument("-r", "--repeat", type=int, default=3)
     parser.add_argument("-e", "--endkey", type=str, default="LCTRL")
     parser.add_argument("-f", "--file", type=str, default="log.txt")
+    parser.add_argument(
+        "-v", "--verify", type=str, default=None,
+        help="log the input stream during playback to the file and "
+             "compare it with the source log")
+    parser.add_argument(
+        "-s", "--scancode", action="store_true",
+        help="replay keys as scan codes for applications reading them")
+    parser.add_argument(
+        "--var", type=str, action="append", default=[],
+        metavar="NAME=VALUE", help="set a template variable")
+    parser.add_argument(
+        "--vars-file", type=str, default=None,
+        help="CSV file of template variables, replayed once per row")
     return parser.parse_args()
 
 
+def load_variants(args) -> list:
+    """Get the template variables of each run from the arguments."""
+    for var in args.var:
+        if "=" not in var:
+            raise ValueError(
+                "Expected NAME=VALUE for --var, got `{}`.".format(var))
+    variables = dict(var.split("=", 1) for var in args.var)
+    if not args.vars_file:
+        return [variables]
+    with open(args.vars_file, "r", newline="", encoding="utf-8") as f:
+        return [dict(variables, **row) for row in csv.DictReader(f)]
+
+
 if __name__ == "__main__":
     logging.basicConfig(
         level=logging.INFO,
@@ -85,10 +180,45 @@ if __name__ == "__main__":
     args = parse_arg()
     END_KEY = VIRTUAL_KEYS_REVERSE[args.endkey]
 
+    # Fail on bad logs and variables before starting the threads below,
+    # which would keep the process alive until the end key is pressed.
+    layout = get_monitor_layout()
+    variants = load_variants(args)
+    scan_table = None
+    if args.scancode:
+        scan_table = log.build_scan_table(map_virtual_key)
+    template = log.Template(args.file, layout, scan_table)
+    for variables in variants:
+        template.check(variables)
+    if args.verify:
+        writer = log.Writer(args.verify, END_KEY, layout, injected_only=True)
+
     # Crearte a thread polling for end key
     t = threading.Thread(target=detect_endkey)
     t.start()
 
-    playback(args.file, args.repeat)
-    ALL_DONE = True
-    t.join()
+    try:
+        if args.verify:
+            ready = threading.Event()
+            v = threading.Thread(target=record_stream, args=(writer, ready))
+            v.start()
+            ready.wait()
+            if STREAM_THREAD_ID is None or not v.is_alive():
+                raise RuntimeError("Failed to install the verification hooks.")
+
+        playback(template, args.repeat, layout, variants, scan_table)
+    finally:
+        ALL_DONE = True
+        t.join()
+
+        if args.verify and STREAM_THREAD_ID is not None:
+            # Give the hooks a moment to receive the last events.
+            time.sleep(0.1)
+            user32.PostThreadMessageA(STREAM_THREAD_ID, WM_QUIT, 0, 0)
+            v.join()
+
+    if args.verify:
+        report = verify.Report(
+            verify.load_events(args.file, args.repeat * len(variants)),
+            verify.load_events(args.verify))
+        logging.info(report.summary())
@@ -4,14 +4,20 @@ record.py - Record the keystrokes and mouse clicks for Windows system.
 Example:
     $python record.py
     # Press `CTRL` key to terminate the recording.
+
+    # Keep the last 300000 events in memory, and write the events of the
+    # last 5 minutes to `log-<timestamp>.txt` when `F12` or CTRL+BREAK is
+    # pressed.
+    $python record.py --ring 300000 --window 5 --dumpkey F12
 """
 import log
 import json
 import logging
 import os
+import signal
 import argparse
 from ctypes import (
-    windll, GetLastError, c_long, c_ulonglong,
+    c_long, c_ulonglong,
     byref, create_unicode_buffer, pointer
 )
 from ctypes.wintypes import RECT
@@ -19,12 +25,6 @@ from ctypes.wintypes import RECT
 from win_const import *
 from win_utils import *
 
-
-# Shorthand for the required dll librairies
-user32 = windll.user32
-kernel32 = windll.kernel32
-shcore = windll.shcore
-
 # Log writter
 writer = None
 
@@ -35,6 +35,9 @@ END_KEY = None
 kb_handle = None
 mouse_handle = None
 
+# Interval of the timer waking up the message loop to serve dump requests
+DUMP_POLL_MS = 500
+
 
 def hook_procedure(nCode, wParam, lParam):
     """Hook procedure to monitor and log for mouse and keyboard events.
@@ -69,6 +72,16 @@ def parse_arg():
     parser = argparse.ArgumentParser(description='Process some integers.')
     parser.add_argument("-e", "--endkey", type=str, default="LCTRL")
     parser.add_argument("-f", "--file", type=str, default="log.txt")
+    parser.add_argument(
+        "-r", "--ring", type=int, default=0, metavar="SIZE",
+        help="keep the last SIZE events in memory and write them only "
+             "when the dump key or signal (CTRL+BREAK, or SIGUSR1) is "
+             "received; a signal is served within {} ms".format(
+                 DUMP_POLL_MS))
+    parser.add_argument(
+        "-w", "--window", type=float, default=None, metavar="MINUTES",
+        help="dump only the events of the last MINUTES")
+    parser.add_argument("-d", "--dumpkey", type=str, default="F12")
     return parser.parse_args()
 
 
@@ -84,9 +97,26 @@ if __name__ == "__main__":
 
     args = parse_arg()
     END_KEY = VIRTUAL_KEYS_REVERSE[args.endkey]
-    writer = log.Writer(args.file, END_KEY)
+    if args.ring:
+        writer = log.RingWriter(
+            args.file, END_KEY, args.ring,
+            window=args.window * 60 if args.window else None,
+            dump_key=VIRTUAL_KEYS_REVERSE[args.dumpkey])
+
+        # CTRL+BREAK on Windows, SIGUSR1 elsewhere.
+        signal.signal(
+            getattr(signal, "SIGBREAK", None) or signal.SIGUSR1,
+            lambda signum, frame: writer.request_dump())
+    else:
+        writer = log.Writer(args.file, END_KEY)
 
     # Retrieves a message from the calling thread's message queue.
     # https://docs.microsoft.com/en-us/windows/win32/api/winuser/nf-winuser-getmessagea
     msg = MSG()
-    user32.GetMessageA(byref(msg), 0, 0, 0)
+    if args.ring:
+        # Signal handlers only run once the main thread leaves GetMessageA,
+        # so wake it up regularly to serve the dumps requested while idle.
+        user32.SetTimer(None, 0, DUMP_POLL_MS, None)
+    while user32.GetMessageA(byref(msg), 0, 0, 0) > 0:
+        if args.ring and writer.dump_requested:
+            writer.dump()
@@ -0,0 +1,136 @@
+"""
+test_core.py - Unit tests of the parts which do not need the Windows API.
+
+Example:
+    $ python -m unittest discover tests
+"""
+import os
+import sys
+import random
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import log        # noqa: E402
+import verify     # noqa: E402
+from monitor import Layout, Transform    # noqa: E402
+
+PRIMARY = (0, 0, 1920, 1080, True)
+LEFT = (-2560, -360, 0, 1080, False)
+
+
+class LayoutTest(unittest.TestCase):
+    def test_monitor_index(self):
+        layout = Layout([LEFT, PRIMARY])
+        self.assertEqual(layout.monitor_index(0, 0), 0)
+        self.assertEqual(layout.monitor_index(1919, 1079), 0)
+        self.assertEqual(layout.monitor_index(-1, 0), 1)
+        self.assertEqual(layout.monitor_index(-2560, -360), 1)
+
+    def test_monitor_index_outside(self):
+        # Points in the gaps fall back to the primary monitor.
+        layout = Layout([LEFT, PRIMARY])
+        self.assertEqual(layout.monitor_index(100, -100), 0)
+        self.assertEqual(layout.monitor_index(5000, 5000), 0)
+
+    def test_log_round_trip(self):
+        layout = Layout([PRIMARY, LEFT])
+        self.assertEqual(Layout.from_log(layout.to_log()), layout)
+
+
+class TransformTest(unittest.TestCase):
+    def assert_edges(self, source, target):
+        """Every monitor edge pixel has to stay on its target monitor."""
+        transform = Transform(source, target)
+        for index, m in enumerate(source.monitors):
+            dst = target.monitors[index] \
+                if index < len(target.monitors) else target.monitors[0]
+            for x in (m.left, m.right - 1):
+                for y in (m.top, m.bottom - 1):
+                    tx, ty = target.denormalize(
+                        *transform.apply(*source.normalize(x, y)))
+                    self.assertTrue(
+                        dst.left <= tx < dst.right and
+                        dst.top <= ty < dst.bottom,
+                        "({}, {}) mapped to ({}, {}) outside {}".format(
+                            x, y, tx, ty, dst))
+
+    def test_edges(self):
+        source = Layout([PRIMARY, LEFT])
+        target = Layout([(0, 0, 1280, 720, True),
+                         (1280, 0, 3200, 1080, False)])
+        self.assert_edges(source, target)
+        self.assert_edges(target, source)
+
+    def test_edges_random_layouts(self):
+        rng = random.Random(0)
+        for _ in range(50):
+            layouts = []
+            for _ in range(2):
+                width, height = rng.randint(640, 3840), rng.randint(480, 2160)
+                monitors = [(0, 0, width, height, True)]
+                x = width
+                for _ in range(rng.randint(0, 2)):
+                    w, h = rng.randint(640, 3840), rng.randint(480, 2160)
+                    y = rng.randint(-h + 1, height - 1)
+                    monitors.append((x, y, x + w, y + h, False))
+                    x += w
+                layouts.append(Layout(monitors))
+            self.assert_edges(*layouts)
+
+    def test_same_layout(self):
+        layout = Layout([PRIMARY])
+        transform = Transform(layout, layout)
+        for x, y in ((0, 0), (960, 540), (1919, 1079)):
+            tx, ty = layout.denormalize(
+                *transform.apply(*layout.normalize(x, y)))
+            self.assertEqual((int(tx), int(ty)), (x, y))
+
+
+def events(names):
+    return [verify.Event(i, name, i * 0.01) for i, name in enumerate(names)]
+
+
+class AlignTest(unittest.TestCase):
+    def test_identical(self):
+        names = ["KeyDown A", "KeyUp A", "MouseMove"] * 100
+        pairs = verify.align(events(names), events(names))
+        self.assertEqual(pairs, [(i, i) for i in range(len(names))])
+
+    def test_dropped_events(self):
+        rng = random.Random(0)
+        expected = ["KeyDown {}".format(rng.choice("ABCDEFGH"))
+                    for _ in range(20000)]
+        dropped = set(rng.sample(range(len(expected)), 300))
+        actual = [name for i, name in enumerate(expected)
+                  if i not in dropped]
+        pairs = verify.align(events(expected), events(actual))
+        self.assertEqual(len(pairs), len(actual))
+        for i, j in pairs:
+            self.assertEqual(expected[i], actual[j])
+        self.assertEqual(pairs, sorted(pairs))
+
+    def test_report(self):
+        expected = ["KeyDown A", "KeyUp A", "KeyDown B", "KeyUp B"]
+        report = verify.Report(events(expected), events(expected))
+        self.assertTrue(report.ok())
+        report = verify.Report(events(expected), events(expected[1:]))
+        self.assertFalse(report.ok())
+        self.assertEqual([e.name for e in report.missing], ["KeyDown A"])
+
+
+class ScanCodeTest(unittest.TestCase):
+    def test_decode_scan_code(self):
+        self.assertEqual(log.decode_scan_code(0x1E), (0x1E, False))
+        self.assertEqual(log.decode_scan_code(0xE04B), (0x4B, True))
+        self.assertEqual(log.decode_scan_code(0xE11D), (0x1D, True))
+
+    def test_build_scan_table(self):
+        codes = {0x41: 0x1E, 0x25: 0xE04B}
+        table = log.build_scan_table(lambda vk: codes.get(vk, 0))
+        self.assertEqual(table, {0x41: (0x1E, False), 0x25: (0x4B, True)})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,364 @@
+"""
+verify.py - Compare the input stream observed during playback with its log.
+
+The module aligns two logs written by `log.Writer`: the source log replayed
+by playback.py and the log recorded by the hooks while replaying it. It only
+parses JSON and does not need the Windows API.
+"""
+import json
+from array import array
+from bisect import bisect_left
+from collections import defaultdict, namedtuple
+
+# Maximum distance in events between a missing and an extra event of the same
+# name to be reported as one reordered event.
+REORDER_WINDOW = 64
+
+# Event kinds sharing the names used in the log file.
+KEYBOARD_EVENTS = ("KeyDown", "KeyUp", "SysKeyDown", "SysKeyUp")
+MOUSE_EVENTS = (
+    "MouseMove",
+    "MouseLeftDown", "MouseLeftUp",
+    "MouseRightDown", "MouseRightUp"
+)
+
+# Upper bound of edit distance for the greedy alignment of the events between
+# two anchors. The trace kept for backtracking grows quadratically with it, so
+# events between anchors further apart are left unmatched.
+MAX_EDITS = 2000
+
+# Runs of ANCHOR_LENGTH events which appear once in both streams split the
+# alignment into small independent parts. Only about one run in
+# ANCHOR_SPACING is considered, chosen by its content so that both streams
+# pick the same runs.
+ANCHOR_LENGTH = 8
+ANCHOR_SPACING = 32
+
+# An input event in a log. `time` is the elapsed seconds since the first line.
+Event = namedtuple("Event", ["index", "name", "time"])
+
+
+def event_name(logs: dict):
+    """Get a comparable name of the event in a log line.
+
+    Mouse positions are not part of the name since the hooks report the
+    cursor position after ballistics and rounding.
+
+    Return:
+        The name such as "KeyDown A" or "MouseLeftDown", None if the line
+        is not an input event.
+    """
+    for key in KEYBOARD_EVENTS:
+        if key in logs:
+            return key + " " + logs[key]
+    names = [key for key in MOUSE_EVENTS if key in logs]
+    if names:
+        return "+".join(names)
+    return None
+
+
+def load_events(filepath, repeat_times=1) -> list:
+    """Load input events from a log file.
+
+    Args:
+        filepath: The path to the log file.
+        repeat_times: Repeat the events as playback.py does.
+
+    Return:
+        A list of Event.
+    """
+    events = []
+    elapsed = 0
+    with open(filepath, "r") as f:
+        lines = f.readlines()
+    for _ in range(repeat_times):
+        for line in lines:
+            logs = json.loads(line)
+            elapsed += logs.get("WAITING_TIME", 0)
+            name = event_name(logs)
+            if name:
+                events.append(Event(len(events), name, elapsed))
+    return events
+
+
+def _snake(a, b, x, y) -> int:
+    """Length of the common run of a[x:] and b[y:].
+
+    The run is found by galloping over slice comparisons, which run in C,
+    so long identical stretches cost O(log n) Python steps.
+    """
+    limit = min(len(a) - x, len(b) - y)
+    lo, step = 0, 1
+    while lo < limit:
+        hi = min(lo + step, limit)
+        if a[x + lo:x + hi] == b[y + lo:y + hi]:
+            lo = hi
+            step *= 2
+        elif step == 1:
+            break
+        else:
+            step = 1
+    return lo
+
+
+def _myers(a, b, max_edits):
+    """Align two sequences with the greedy O((N+M)D) algorithm of Myers.
+
+    Return:
+        A list of (i, j) index pairs of matched items, or None if the edit
+        distance exceeds `max_edits`.
+    """
+    n, m = len(a), len(b)
+    offset = n + m + 1
+    v = [0] * (2 * offset + 1)
+    trace = []
+    for d in range(min(n + m, max_edits) + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            x += _snake(a, b, x, y)
+            v[offset + k] = x
+            if x >= n and x - k >= m:
+                trace.append(v[offset - d:offset + d + 1])
+                return _backtrack(trace, n, m)
+        trace.append(v[offset - d:offset + d + 1])
+    return None
+
+
+def _backtrack(trace, n, m):
+    """Recover the matched pairs from the trace of `_myers()`."""
+    pairs = []
+    x, y = n, m
+    for d in reversed(range(len(trace))):
+        k = x - y
+        if d == 0:
+            prev_x = prev_y = 0
+        else:
+            prev = trace[d - 1]
+
+            def at(diag):
+                return prev[diag + d - 1]
+            if k == -d or (k != d and at(k - 1) < at(k + 1)):
+                prev_k = k + 1
+            else:
+                prev_k = k - 1
+            prev_x = at(prev_k)
+            prev_y = prev_x - prev_k
+        # Diagonal moves are matches.
+        while x > prev_x and y > prev_y:
+            x, y = x - 1, y - 1
+            pairs.append((x, y))
+        x, y = prev_x, prev_y
+    pairs.reverse()
+    return pairs
+
+
+def _runs(seq) -> dict:
+    """Find the candidate anchor runs of a sequence.
+
+    Return:
+        A dictionary mapping the content of a run to its position, or -1 if
+        the run appears more than once.
+    """
+    data = array("I", seq).tobytes()
+    width = 4 * ANCHOR_LENGTH
+    runs = {}
+    for i in range(0, len(data) - width + 4, 4):
+        run = data[i:i + width]
+        if hash(run) % ANCHOR_SPACING == 0:
+            runs[run] = -1 if run in runs else i // 4
+    return runs
+
+
+def _anchors(a, b) -> list:
+    """Find runs appearing once in both sequences and in the same order.
+
+    Return:
+        A list of (i, j) positions of non-overlapping equal runs, increasing
+        in both sequences.
+    """
+    runs_b = _runs(b)
+    candidates = sorted(
+        (i, runs_b[run]) for run, i in _runs(a).items()
+        if i >= 0 and runs_b.get(run, -1) >= 0)
+
+    # Longest increasing subsequence of j, as in patience diff.
+    tails, tail_index, previous = [], [], []
+    for n, (_, j) in enumerate(candidates):
+        k = bisect_left(tails, j)
+        if k == len(tails):
+            tails.append(j)
+            tail_index.append(n)
+        else:
+            tails[k] = j
+            tail_index[k] = n
+        previous.append(tail_index[k - 1] if k else -1)
+    chain = []
+    n = tail_index[-1] if tail_index else -1
+    while n >= 0:
+        chain.append(candidates[n])
+        n = previous[n]
+    chain.reverse()
+
+    anchors = []
+    for i, j in chain:
+        if not anchors or (i >= anchors[-1][0] + ANCHOR_LENGTH and
+                           j >= anchors[-1][1] + ANCHOR_LENGTH):
+            anchors.append((i, j))
+    return anchors
+
+
+def _align_part(a, b, max_edits) -> list:
+    """Align two sequences with few differences.
+
+    Return:
+        A list of (i, j) index pairs of matched items.
+    """
+    # Replays are usually nearly identical, so strip the common head and
+    # tail before aligning the rest.
+    head = _snake(a, b, 0, 0)
+    tail = 0
+    while tail < min(len(a), len(b)) - head and \
+            a[len(a) - tail - 1] == b[len(b) - tail - 1]:
+        tail += 1
+    mid_a, mid_b = a[head:len(a) - tail], b[head:len(b) - tail]
+
+    # Too different to be aligned cheaply, which only happens if the
+    # anchors are far apart. Report the middle as missing and extra.
+    middle = _myers(mid_a, mid_b, max_edits) or []
+
+    pairs = [(i, i) for i in range(head)]
+    pairs += [(i + head, j + head) for i, j in middle]
+    pairs += [(len(a) - tail + i, len(b) - tail + i) for i in range(tail)]
+    return pairs
+
+
+def align(expected: list, actual: list, max_edits=MAX_EDITS) -> list:
+    """Align the expected events with the actual events.
+
+    The streams are split at anchors, and the events between two anchors
+    are aligned with the greedy algorithm of Myers, so the time grows with
+    the length of the streams and the density of the differences rather
+    than with their total number.
+
+    Args:
+        expected: Events of the source log.
+        actual: Events observed during playback.
+        max_edits: See MAX_EDITS.
+
+    Return:
+        A list of (expected index, actual index) pairs of matched events.
+    """
+    # Intern the names so the sequences are compared as ints.
+    ids = {}
+    a = [ids.setdefault(e.name, len(ids)) for e in expected]
+    b = [ids.setdefault(e.name, len(ids)) for e in actual]
+
+    pairs = []
+    start_i = start_j = 0
+    for i, j in _anchors(a, b) + [(len(a), len(b))]:
+        part = _align_part(a[start_i:i], b[start_j:j], max_edits)
+        pairs += [(start_i + x, start_j + y) for x, y in part]
+        pairs += [(i + n, j + n) for n in range(ANCHOR_LENGTH)
+                  if i + n < len(a)]
+        start_i, start_j = i + ANCHOR_LENGTH, j + ANCHOR_LENGTH
+    return pairs
+
+
+class Report:
+    def __init__(self, expected: list, actual: list, max_edits=MAX_EDITS):
+        """Constructor for comparing the expected and actual events.
+
+        Unmatched events with the same name in both streams within
+        REORDER_WINDOW events of each other are reported as reordered, the
+        rest as missing or extra.
+
+        Args:
+            expected: Events of the source log.
+            actual: Events observed during playback.
+            max_edits: See MAX_EDITS.
+        """
+        self.expected = expected
+        self.actual = actual
+        self.matched = align(expected, actual, max_edits)
+
+        matched_a = {i for i, _ in self.matched}
+        matched_b = {j for _, j in self.matched}
+        missing = [e for e in expected if e.index not in matched_a]
+        extra = [e for e in actual if e.index not in matched_b]
+
+        # Pair the unmatched events by name around the position where the
+        # missing event is expected in the actual stream.
+        pending = defaultdict(list)
+        for e in extra:
+            pending[e.name].append(e.index)
+        matched_i = [i for i, _ in self.matched]
+        self.reordered = []
+        self.missing = []
+        for e in missing:
+            n = bisect_left(matched_i, e.index)
+            if n:
+                i, j = self.matched[n - 1]
+                estimate = j + e.index - i
+            else:
+                estimate = e.index
+            candidates = pending[e.name]
+            n = bisect_left(candidates, estimate)
+            nearest = min(
+                (c for c in (n - 1, n) if 0 <= c < len(candidates)),
+                key=lambda c: abs(candidates[c] - estimate), default=None)
+            if nearest is not None and \
+                    abs(candidates[nearest] - estimate) <= REORDER_WINDOW:
+                self.reordered.append(
+                    (e, actual[candidates.pop(nearest)]))
+            else:
+                self.missing.append(e)
+        reordered_b = {b.index for _, b in self.reordered}
+        self.extra = [e for e in extra if e.index not in reordered_b]
+
+        # Timing skew of matched events relative to the first matched pair.
+        self.skews = []
+        if self.matched:
+            i0, j0 = self.matched[0]
+            base = actual[j0].time - expected[i0].time
+            self.skews = [actual[j].time - expected[i].time - base
+                          for i, j in self.matched]
+
+    def ok(self) -> bool:
+        """Whether every event is delivered in order."""
+        return not (self.missing or self.extra or self.reordered)
+
+    def summary(self, limit=10) -> str:
+        """Format a human readable summary.
+
+        Args:
+            limit: Maximum number of events listed per category.
+        """
+        lines = [
+            "{} expected, {} observed, {} matched.".format(
+                len(self.expected), len(self.actual), len(self.matched)),
+            "{} missing, {} extra, {} reordered.".format(
+                len(self.missing), len(self.extra), len(self.reordered))
+        ]
+        if self.skews:
+            abs_skews = sorted(abs(s) for s in self.skews)
+            lines.append(
+                "Timing skew: mean {:.4f} sec, p95 {:.4f} sec, "
+                "max {:.4f} sec, final {:+.4f} sec.".format(
+                    sum(abs_skews) / len(abs_skews),
+                    abs_skews[int(0.95 * (len(abs_skews) - 1))],
+                    abs_skews[-1],
+                    self.skews[-1]))
+        for e in self.missing[:limit]:
+            lines.append("Missing #{} `{}` at {:.3f} sec.".format(
+                e.index, e.name, e.time))
+        for e in self.extra[:limit]:
+            lines.append("Extra #{} `{}` at {:.3f} sec.".format(
+                e.index, e.name, e.time))
+        for a, b in self.reordered[:limit]:
+            lines.append("Reordered #{} `{}` observed as #{}.".format(
+                a.index, a.name, b.index))
+        return "\n".join(lines)
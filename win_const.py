@@ -3,11 +3,17 @@ win_const.py - Definition of data structure and consts for the Windows API.
 """
 
 from ctypes import (
-    WINFUNCTYPE, HRESULT, c_int, Structure, Union
+    c_int, Structure, Union
 )
+try:
+    from ctypes import WINFUNCTYPE, HRESULT
+except ImportError:
+    # Outside of Windows the module is only imported to work on logs, and
+    # the callback function types are never called.
+    from ctypes import CFUNCTYPE as WINFUNCTYPE, c_long as HRESULT
 from ctypes.wintypes import (
     WORD, DWORD, LPARAM, WPARAM, MSG,
-    POINT, PULONG, LONG
+    POINT, PULONG, LONG, BOOL, HMONITOR, HDC, LPRECT, RECT
 )
 
 # Windows hook ID
@@ -29,6 +35,7 @@ WM_LBUTTONDOWN = 0x0201   # Posted when the user presses the left mouse button
 WM_LBUTTONUP = 0x0202     # Posted when the user releases the left mouse button
 WM_RBUTTONDOWN = 0x0204   # Posted when the user presses the right mouse button
 WM_RBUTTONUP = 0x0205     # Posted when the user releases the right mouse button
+WM_QUIT = 0x0012          # Indicates a request to terminate the message loop
 
 # A code the hook procedure uses to determine how to process the keyboard/mouse
 # message.
@@ -144,6 +151,7 @@ VIRTUAL_KEYS_REVERSE = {
 HOOKPROC = WINFUNCTYPE(HRESULT, c_int, WPARAM, LPARAM)
 
 
+
 # Contains information about a low-level keyboard input event.
 # KBDLLHOOKSTRUCT structure (winuser.h)
 # https://docs.microsoft.com/en-us/windows/win32/api/winuser/ns-winuser-kbdllhookstruct
@@ -157,6 +165,12 @@ class KBDLLHOOKSTRUCT(Structure):
     ]
 
 
+# Event-injected flags of KBDLLHOOKSTRUCT and MSLLHOOKSTRUCT.
+LLKHF_EXTENDED = 0x00000001
+LLKHF_INJECTED = 0x00000010
+LLMHF_INJECTED = 0x00000001
+
+
 # Contains information about a low-level mouse input event.
 # MSLLHOOKSTRUCT structure (winuser.h)
 # https://docs.microsoft.com/en-us/windows/win32/api/winuser/ns-winuser-msllhookstruct?redirectedfrom=MSDN
@@ -189,6 +203,7 @@ MOUSEEVENTF_LEFTDOWN = 0x0002   # The left button was pressed.
 MOUSEEVENTF_LEFTUP = 0x0004     # The left button was released.
 MOUSEEVENTF_RIGHTDOWN = 0x0008  # The right button was pressed.
 MOUSEEVENTF_RIGHTUP = 0x0010    # The right button was released.
+MOUSEEVENTF_VIRTUALDESK = 0x4000    # Maps coordinates to the entire desktop.
 MOUSEEVENTF_ABSOLUTE = 0x8000   # Indicates the dx and dy is normalized.
 
 
@@ -244,7 +259,15 @@ INPUT_HARDWARE = 2  # Hardware event. Use the hi structure of the union.
 
 # Various aspects of a keystroke
 # https://docs.microsoft.com/en-us/windows/win32/api/winuser/ns-winuser-keybdinput
+KEYEVENTF_EXTENDEDKEY = 0x0001
 KEYEVENTF_KEYUP = 0x0002
+KEYEVENTF_UNICODE = 0x0004
+KEYEVENTF_SCANCODE = 0x0008
+
+# Translates a virtual-key code into a scan code with the 0xE0 or 0xE1 prefix
+# of extended keys in the high byte.
+# https://docs.microsoft.com/en-us/windows/win32/api/winuser/nf-winuser-mapvirtualkeyw
+MAPVK_VK_TO_VSC_EX = 4
 
 # Determines the function's return value if the window does not intersect any
 # display monitor.
@@ -252,6 +275,30 @@ KEYEVENTF_KEYUP = 0x0002
 # https://lazarus-ccr.sourceforge.io/docs/lcl/lcltype/monitor_defaulttoprimary.html
 MONITOR_DEFAULTTOPRIMARY = 1
 
+# Contains information about a display monitor.
+# MONITORINFO structure (winuser.h)
+# https://docs.microsoft.com/en-us/windows/win32/api/winuser/ns-winuser-monitorinfo
+class MONITORINFO(Structure):
+    _fields_ = [
+        ("cbSize", DWORD),
+        ("rcMonitor", RECT),
+        ("rcWork", RECT),
+        ("dwFlags", DWORD)
+    ]
+
+
+MONITORINFOF_PRIMARY = 0x00000001   # This is the primary display monitor.
+
+# A callback function signature used with the EnumDisplayMonitors function.
+# https://docs.microsoft.com/en-us/windows/win32/api/winuser/nc-winuser-monitorenumproc
+MONITORENUMPROC = WINFUNCTYPE(BOOL, HMONITOR, HDC, LPRECT, LPARAM)
+
+# Per-monitor DPI awareness, so that hook points and monitor rectangles are
+# both reported in physical pixels.
+# https://docs.microsoft.com/en-us/windows/win32/api/shellscalingapi/ne-shellscalingapi-process_dpi_awareness
+PROCESS_PER_MONITOR_DPI_AWARE = 2
+
 # Common HRESULT Values
 # https://docs.microsoft.com/en-us/windows/win32/seccrypto/common-hresult-values
 S_OK = 0x00000000   # Operation successful
+
@@ -1,14 +1,29 @@
+import ctypes
 import logging
 from ctypes import (
-    windll, GetLastError, pointer, c_long)
-from ctypes.wintypes import RECT
+    pointer, sizeof, c_int)
 
+import monitor
 from win_const import *
 
-# Shorthand for the required dll librairies
-user32 = windll.user32
-kernel32 = windll.kernel32
-shcore = windll.shcore
+
+class _LazyDLL:
+    """Windows dll library loaded on the first function lookup."""
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        # Called only for attributes which are not cached yet.
+        func = getattr(getattr(ctypes.windll, self._name), attr)
+        setattr(self, attr, func)
+        return func
+
+
+# Shorthand for the required dll librairies shared by all modules
+user32 = _LazyDLL("user32")
+kernel32 = _LazyDLL("kernel32")
+shcore = _LazyDLL("shcore")
 
 
 def install_hook(hook_id, proc):
@@ -24,7 +39,7 @@ def install_hook(hook_id, proc):
     handle = user32.SetWindowsHookExA(hook_id, proc, None, 0)
     if not handle:
         # https://docs.microsoft.com/en-us/windows/win32/debug/system-error-codes--0-499-
-        msg = "Failed to install hook. errno=" + str(GetLastError())
+        msg = "Failed to install hook. errno=" + str(ctypes.GetLastError())
         logging.error(msg)
     return handle
 
@@ -55,50 +70,61 @@ def is_pressed(vkey) -> bool:
     return bool(user32.GetKeyState(vkey) & 0x8000)
 
 
-def get_screen_resolution() -> (int, int):
-    """Get screen resolution before rescaling.
+def send_input(in_arr):
+    """Synthesizes keystrokes, mouse motions, and button clicks.
 
-    Return:
-        x, y: the screen resolution before rescaling.
+    https://docs.microsoft.com/en-us/windows/win32/api/winuser/nf-winuser-sendinput
+
+    Args:
+        in_arr: An array of INPUT structures.
     """
-    h_desktop = user32.GetDesktopWindow()
-
-    # Get screen resoltion virtualized for DPI
-    rect = RECT()
-    success = user32.GetWindowRect(h_desktop, pointer(rect))
-    if not success:
-        raise OSError(GetLastError())
-
-    # Get rescale factor for primary monitor
-    hmonitor = user32.MonitorFromWindow(
-        h_desktop, MONITOR_DEFAULTTOPRIMARY)
-    rescale_factor = c_long(0)
-    result = shcore.GetScaleFactorForMonitor(
-        hmonitor, pointer(rescale_factor))
-    if result != S_OK:
-        logging.error("GetScaleFactorForMonitor failed.")
-        raise OSError(GetLastError())
-
-    # Calcuate the resolution before scaling.
-    rescale_factor = rescale_factor.value
-    res_x = int((rect.right - rect.left) * rescale_factor / 100)
-    res_y = int((rect.bottom - rect.top) * rescale_factor / 100)
-    return res_x, res_y
-
-
-def normalized_screen_coordinates(x, y) -> (int, int):
-    """Normalized x, y to absolute coordinates. (0-65535)
-
-    The absolute position is normalized between 0 and 65535. Refer to the
-    website for more details about the Windows mouse input event.
-    https://docs.microsoft.com/en-us/windows/win32/api/winuser/ns-winuser-mouseinput
+    nums = user32.SendInput(len(in_arr), in_arr, c_int(sizeof(INPUT)))
+    if nums < len(in_arr):
+        raise OSError(ctypes.GetLastError())
+
+
+def map_virtual_key(vkey) -> int:
+    """Translate a virtual-key code into a scan code.
 
     Args:
-        x: x-axis on screen coordinates.
-        y: y-axis on screen coordinates.
+        vkey: virtual-key code
+
+    Return:
+        The scan code with the 0xE0 or 0xE1 prefix of extended keys in the
+        high byte, 0 if there is no translation.
+    """
+    return user32.MapVirtualKeyW(vkey, MAPVK_VK_TO_VSC_EX)
 
-    Return
-        x, y: Normalized x, y from 0 to 65535
+
+def get_monitor_layout() -> monitor.Layout:
+    """Capture the layout of all display monitors on the virtual desktop.
+
+    The process is switched to per-monitor DPI awareness first, so the
+    monitor rectangles and the points reported by the low-level mouse hook
+    share the same physical pixel coordinates.
+
+    Return:
+        A monitor.Layout describing every monitor in virtual screen
+        coordinates.
     """
-    res_x, res_y = get_screen_resolution()
-    return int(x * 65536 / res_x), int(y * 65536 / res_y)
+    # Fails with E_ACCESSDENIED if the awareness is already set.
+    shcore.SetProcessDpiAwareness(PROCESS_PER_MONITOR_DPI_AWARE)
+
+    monitors = []
+
+    def callback(hmonitor, hdc, lprect, lparam):
+        info = MONITORINFO()
+        info.cbSize = sizeof(MONITORINFO)
+        if not user32.GetMonitorInfoW(hmonitor, pointer(info)):
+            raise OSError(ctypes.GetLastError())
+        rect = info.rcMonitor
+        monitors.append(monitor.Monitor(
+            rect.left, rect.top, rect.right, rect.bottom,
+            bool(info.dwFlags & MONITORINFOF_PRIMARY)))
+        return True
+
+    # https://docs.microsoft.com/en-us/windows/win32/api/winuser/nf-winuser-enumdisplaymonitors
+    proc = MONITORENUMPROC(callback)
+    if not user32.EnumDisplayMonitors(None, None, proc, 0):
+        raise OSError(ctypes.GetLastError())
+    return monitor.Layout(monitors)